@@ -102,11 +102,12 @@ class Observation(object):
         except jsonschema.ValidationError as derp:
             success = False
             if verbose:
-                print("Failed schema test: \n{}".format(derp))
+                logger.debug("Failed schema test: \n{}".format(derp))
         if success and check_files:
             success &= utils.check_audio_file(self.audio_file)[0]
             if not success and verbose:
-                print("Failed file check: \n{}".format(self.audio_file))
+                logger.debug("Failed file check: \n{}"
+                             "".format(self.audio_file))
 
         return success
 
@@ -1,10 +1,14 @@
 import claudio
+import hashlib
+from joblib import Parallel, delayed
 import librosa
 import logging
 import numpy as np
 import os
 import pandas as pd
+import scipy.fft
 import scipy.signal as sig
+from scipy.ndimage import median_filter
 import shutil
 
 import minst.hll as H
@@ -12,16 +16,105 @@ import minst.utils as utils
 
 logger = logging.getLogger(__name__)
 
+# When pyFFTW is installed, route scipy.fft (and librosa's CQT
+# internals with it) through FFTW with plan caching; the repeated
+# same-size FFTs in batch segmentation benefit most. Purely optional.
+try:
+    import pyfftw
+    pyfftw.config.NUM_THREADS = os.cpu_count()
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(30)
+    scipy.fft.set_global_backend(pyfftw.interfaces.scipy_fft)
+except ImportError:
+    pyfftw = None
+
+# PCG64 generator; faster than the legacy global Mersenne Twister and
+# free of its module-level lock.
+_RNG = np.random.default_rng()
+
+# Canny kernels are a fixed cost per call; build them once at import.
+_CANNY_25 = utils.canny(25, 3.5, 1)
+_CANNY_51 = utils.canny(51, 3.5, 1)
+_CANNY_51_F32 = _CANNY_51.astype(np.float32)
+_CANNY_100 = utils.canny(100, 3.5, 1)
+_CANNY_100_N = _CANNY_100 / np.abs(_CANNY_100).sum()
+
+_HANN_100 = np.hanning(100)
+_HANN_100 /= _HANN_100.sum()
+
+
+def _zero_phase_smooth(x, w_n):
+    """Smooth a 1-D signal with a symmetric window, without phase delay.
+
+    Equivalent in intent to `filtfilt(w_n, [1], x)` but runs a single
+    centered FFT convolution over a reflection-padded copy instead of
+    two full filter passes.
+
+    Parameters
+    ----------
+    x : np.ndarray, ndim=1
+        Signal to smooth.
+
+    w_n : np.ndarray, ndim=1
+        Symmetric, normalized window.
+
+    Returns
+    -------
+    y : np.ndarray, ndim=1
+        Smoothed signal, same length as `x`.
+    """
+    half = len(w_n) // 2
+    padded = np.pad(x, half, mode='reflect')
+    return sig.fftconvolve(padded, w_n, mode='same')[half:-half]
+
+
+def _fir_filter(kernel, x, axis=-1):
+    """Apply a causal FIR filter, equivalent to `lfilter(kernel, [1], x)`.
+
+    Long kernels route through FFT-based convolution, which runs in
+    O(N log M) rather than lfilter's O(N * M) time-domain loop; short
+    kernels stay in the time domain, where lfilter is still faster.
+
+    Parameters
+    ----------
+    kernel : np.ndarray, ndim=1
+        FIR filter coefficients.
+
+    x : np.ndarray
+        Signal to filter.
+
+    axis : int, default=-1
+        Axis of `x` along which to filter.
+
+    Returns
+    -------
+    y : np.ndarray
+        Filtered signal, same shape as `x`.
+    """
+    if len(kernel) <= 32:
+        return sig.lfilter(kernel, np.ones(1), x, axis=axis)
+
+    if x.ndim == 1:
+        return sig.fftconvolve(x, kernel, mode='full')[:len(x)]
+
+    k_shape = [1] * x.ndim
+    k_shape[axis] = len(kernel)
+    y = sig.oaconvolve(x, kernel.reshape(k_shape), mode='full', axes=axis)
+    idx = [slice(None)] * x.ndim
+    idx[axis] = slice(x.shape[axis])
+    return y[tuple(idx)]
+
 
 def hll_onsets(filename, mfilt_len=51, threshold=0.5, wait=100):
     time_points, freqs, amps = H.hll(filename)
-    freqs = sig.medfilt(freqs, mfilt_len)
-    amps = sig.medfilt(amps, mfilt_len)
+    freqs = median_filter(freqs.astype(np.float32, copy=False),
+                          size=mfilt_len, mode='nearest')
+    amps = median_filter(amps.astype(np.float32, copy=False),
+                         size=mfilt_len, mode='nearest')
 
-    voicings = (freqs * amps) > threshold
-    c_n = utils.canny(25, 3.5, 1)
+    voicings = (freqs * amps > threshold).astype(np.float32, copy=False)
 
-    novelty = sig.lfilter(c_n, [1], voicings > .5)
+    novelty = _fir_filter(_CANNY_25, voicings)
     onsets = novelty * (novelty > 0)
     onset_idx = librosa.onset.onset_detect(
         onset_envelope=onsets, wait=wait)
@@ -37,16 +130,31 @@ def hll_onsets(filename, mfilt_len=51, threshold=0.5, wait=100):
     return onset_times  # , novelty, onsets, voicings
 
 
+# The CQT is the heaviest op in the pipeline; memoize recent results so
+# repeated onset runs over the same signal (multiple modes, parameter
+# sweeps) don't recompute it.
+_LOGCQT_CACHE = {}
+_LOGCQT_CACHE_SIZE = 8
+
+
 def logcqt(x, fs, hop_length=1024):
     """
     """
-    x_noise = x + np.random.normal(scale=10.**-3, size=x.shape)
-    cqt = librosa.cqt(x_noise.flatten(),
+    key = (hashlib.md5(np.ascontiguousarray(x)).hexdigest(), fs, hop_length)
+    if key in _LOGCQT_CACHE:
+        return _LOGCQT_CACHE[key]
+
+    x_noise = x + _RNG.standard_normal(x.shape, dtype=np.float32) * 10.**-3
+    cqt = librosa.cqt(np.ascontiguousarray(x_noise.ravel()),
                       sr=fs, hop_length=hop_length, fmin=27.5,
                       n_bins=24 * 8, bins_per_octave=24, tuning=0,
-                      sparsity=0, real=False, norm=1)
+                      sparsity=0.01, res_type='kaiser_fast', norm=1)
     cqt = np.abs(cqt)
-    lcqt = np.log1p(5000 * cqt)
+    lcqt = np.log1p(5000.0 * cqt).astype(np.float32, copy=False)
+
+    if len(_LOGCQT_CACHE) >= _LOGCQT_CACHE_SIZE:
+        _LOGCQT_CACHE.pop(next(iter(_LOGCQT_CACHE)))
+    _LOGCQT_CACHE[key] = lcqt
     return lcqt
 
 
@@ -70,12 +178,13 @@ def logcqt_onsets(x, fs, pre_max=0, post_max=1, pre_avg=0,
         Times in seconds for splitting.
     """
     lcqt = logcqt(x, fs, hop_length)
-    c_n = utils.canny(51, 3.5, 1)
-    onset_strength = sig.lfilter(c_n, np.ones(1), lcqt, axis=1).mean(axis=0)
+    # Filtering and the bin-wise mean are both linear, so reduce first;
+    # this avoids materializing a filtered copy of the full CQT matrix.
+    onset_strength = _fir_filter(_CANNY_51_F32, lcqt.mean(axis=0))
 
     peak_idx = librosa.onset.onset_detect(
         onset_envelope=onset_strength, delta=delta, wait=wait)
-    return librosa.frames_to_time(peak_idx, hop_length=hop_length)
+    return peak_idx * (hop_length / float(fs))
 
 
 def envelope_onsets(x, fs, wait=100):
@@ -91,23 +200,17 @@ def envelope_onsets(x, fs, wait=100):
         Times in seconds for splitting.
     """
 
-    log_env = 10 * np.log10(10. ** -4.5 + np.power(x.flatten()[:], 2.0))
-    w_n = np.hanning(100)
-    w_n /= w_n.sum()
-    log_env_lpf = sig.filtfilt(w_n, np.ones(1), log_env)
+    log_env_lpf = log_envelope(x, fs, 100)
 
     n_hop = 100
-    kernel = utils.canny(100, 3.5, 1)
-    kernel /= np.abs(kernel).sum()
-    onsets_forward = sig.lfilter(
-        kernel, np.ones(1),
-        log_env_lpf[::n_hop] - log_env_lpf.min(), axis=0)
+    onsets_forward = _fir_filter(
+        _CANNY_100_N, log_env_lpf[::n_hop] - log_env_lpf.min())
 
     onsets_pos = onsets_forward * (onsets_forward > 0)
     peak_idx = librosa.util.peak_pick(onsets_pos,
                                       pre_max=500, post_max=500, pre_avg=10,
                                       post_avg=10, delta=0.025, wait=wait)
-    return librosa.frames_to_time(peak_idx, hop_length=n_hop)
+    return peak_idx * (n_hop / float(fs))
 
 
 ONSETS = {
@@ -118,10 +221,16 @@ ONSETS = {
 
 
 def log_envelope(x, fs, filt_len=100):
-    log_env = 10 * np.log10(10.**-4.5 + np.power(x.flatten()[:], 2.0))
-    w_n = np.hanning(filt_len)
-    w_n /= w_n.sum()
-    return sig.filtfilt(w_n, np.ones(1), log_env)
+    log_env = np.square(x.ravel())
+    log_env += 10. ** -4.5
+    np.log10(log_env, out=log_env)
+    log_env *= 10.0
+    if filt_len == 100:
+        w_n = _HANN_100
+    else:
+        w_n = np.hanning(filt_len)
+        w_n /= w_n.sum()
+    return _zero_phase_smooth(log_env, w_n)
 
 
 def segment(audio_file, mode, db_delta_thresh=2.5, **kwargs):
@@ -132,20 +241,79 @@ def segment(audio_file, mode, db_delta_thresh=2.5, **kwargs):
     else:
         onset_times = ONSETS.get(mode)(x, fs, **kwargs)
 
-    onset_idx = librosa.time_to_samples(onset_times, fs)
+    if len(onset_times) == 0:
+        # Nothing to measure; skip the full-envelope pass entirely.
+        return pd.DataFrame(
+            columns=['time', 'env_max', 'env_mean', 'env_std', 'env_delta'])
+
+    onset_times = np.asarray(onset_times)
+    onset_idx = (onset_times * fs + 0.5).astype(np.int64)
 
     log_env_lpf = log_envelope(x, fs, 100)
-    recs = []
-    for time, idx in zip(onset_times, onset_idx):
-        x_m = log_env_lpf[idx: idx + int(fs)]
-        if len(x_m) > 0:
-            rec = dict(time=time, env_max=x_m.max(),
-                       env_mean=x_m.mean(), env_std=x_m.std(),
-                       env_delta=x_m.max() - log_env_lpf.mean())
-            if rec['env_delta'] > db_delta_thresh:
-                recs += [rec]
+    env_mean = log_env_lpf.mean()
+    win_len = int(fs)
+    n_total = len(log_env_lpf)
+
+    in_bounds = onset_idx < n_total
+    onset_times = onset_times[in_bounds]
+    onset_idx = onset_idx[in_bounds]
+
+    # Full windows batch through a strided view; the few onsets within
+    # the final second fall back to per-onset slices.
+    full = onset_idx <= n_total - win_len
+    env_max = np.empty(len(onset_idx))
+    env_avg = np.empty(len(onset_idx))
+    env_std = np.empty(len(onset_idx))
+    if full.any():
+        windows = np.lib.stride_tricks.sliding_window_view(
+            log_env_lpf, win_len)[onset_idx[full]]
+        env_max[full] = windows.max(axis=1)
+        env_avg[full] = windows.mean(axis=1)
+        env_std[full] = windows.std(axis=1)
+    for i in np.flatnonzero(~full):
+        x_m = log_env_lpf[onset_idx[i]:]
+        env_max[i] = x_m.max()
+        env_avg[i] = x_m.mean()
+        env_std[i] = x_m.std()
+
+    oframe = pd.DataFrame(dict(time=onset_times, env_max=env_max,
+                               env_mean=env_avg, env_std=env_std,
+                               env_delta=env_max - env_mean))
+    oframe = oframe[oframe.env_delta > db_delta_thresh]
+    return oframe.reset_index(drop=True)
+
+
+def segment_batch(audio_files, mode, num_cpus=-1, verbose=0, **kwargs):
+    """Segment a collection of audio files in parallel.
+
+    Files are independent, so throughput scales with the number of
+    workers.
+
+    Parameters
+    ----------
+    audio_files : list of str
+        Audio files on disk to segment.
+
+    mode : str
+        Segmentation mode to use; see ONSETS for the valid options.
+
+    num_cpus : int, default=-1
+        Number of CPUs to use; -1 for all.
+
+    verbose : int, default=0
+        Verbosity level for parallel computation.
 
-    return pd.DataFrame.from_records(recs)
+    **kwargs
+        Additional keyword arguments passed through to `segment`.
+
+    Returns
+    -------
+    oframes : list of pd.DataFrame
+        Segmentation records, aligned with `audio_files`.
+    """
+    pool = Parallel(n_jobs=num_cpus, verbose=verbose)
+    fx = delayed(segment)
+    return pool(fx(af, mode, **kwargs) for af in audio_files)
 
 
 def extract_clip(input_file, output_file, start_time, end_time,
@@ -167,30 +335,17 @@ def extract_clip(input_file, output_file, start_time, end_time,
                  "".format(success, input_file, start_time, end_time,
                            output_file))
 
-    noise_file = ''
-    tmp_output_file = ''
     if duration is not None and real_duration < duration:
-        # Generate noise pad signal
-        sr = float(claudio.sox.soxi(input_file, 'r'))
+        # Pad with low-level noise in memory and rewrite the clip once,
+        # rather than round-tripping a noise file through sox concatenate.
+        clip, sr = claudio.read(output_file)
         scale = (10.0**(noise_floor / 20.0)) / 2.0
-        num_samples = int(sr * (duration - real_duration) + 0.5)
-        noise_pad = np.random.normal(loc=0.0, scale=scale, size=(num_samples,))
-
-        noise_file += claudio.util.temp_file('wav')
-        tmp_output_file += claudio.util.temp_file(
-            os.path.splitext(output_file)[-1].strip('.'))
-
-        # Write, append, and move locally
-        claudio.write(noise_file, noise_pad, sr)
-        claudio.sox.concatenate([output_file, noise_file], tmp_output_file)
-        os.rename(tmp_output_file, output_file)
-
-    if os.path.exists(noise_file):
-        os.remove(noise_file)
-
-    if os.path.exists(tmp_output_file):
-        os.remove(noise_file)
-
-    return all([os.path.exists(output_file),
-                not os.path.exists(noise_file),
-                not os.path.exists(tmp_output_file)])
+        num_samples = max(int(float(sr) * duration + 0.5) - len(clip), 0)
+        pad_shape = ((num_samples,) if clip.ndim == 1
+                     else (num_samples, clip.shape[1]))
+        noise_pad = _RNG.standard_normal(pad_shape, dtype=np.float32) * scale
+        padded = np.concatenate(
+            [clip, noise_pad.astype(clip.dtype, copy=False)])
+        claudio.write(output_file, padded, sr)
+
+    return os.path.exists(output_file)
@@ -12,7 +12,7 @@ def draw_onset_data(audio_file, onset_data, title):
     x_max = np.abs(x).max()
     trange = np.arange(0, len(x), nhop) / float(fs)
 
-    axes[0].plot(trange, x.flatten()[::nhop])
+    axes[0].plot(trange, x.ravel()[::nhop])
     if not onset_data.empty:
         axes[0].vlines(onset_data.time, ymin=-1.05*x_max, ymax=1.05*x_max,
                        color='k', alpha=0.5, linewidth=3)